@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import threading
+from typing import AnyStr, Optional, Tuple
+
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'dedup',
+                          'hashes.sqlite3')
+# Inserted digests are committed in batches
+COMMIT_EVERY = 10000
+# Device, inode, size, modification and change time in nanoseconds, taken from the stat result of the walk
+CacheKey = Tuple[int, int, int, int, int]
+
+
+class HashCache:
+    """
+    Digests of previous runs keyed by device and inode, valid while size, modification and change times are unchanged.
+    The change time can't be set by the user, so a file restored with an old modification time is hashed again.
+    Rows are never pruned, a deleted file's row stays until its inode is reused or the database is deleted
+    """
+
+    def __init__(self, path: AnyStr = CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Shared by the hashing threads, every access holds the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, algorithm TEXT, '
+                                'size INTEGER, mtime INTEGER, ctime INTEGER, digest BLOB, '
+                                'PRIMARY KEY (dev, ino, algorithm))')
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def get(self, key: CacheKey, algorithm: str) -> Optional[bytes]:
+        """
+        :param key: cache key of the file
+        :param algorithm: hash algorithm name
+        :return: cached digest or None if the file is unknown or has changed
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime, ctime, digest FROM hashes '
+                                          'WHERE dev = ? AND ino = ? AND algorithm = ?',
+                                          (key[0], key[1], algorithm)).fetchone()
+        if row and row[:3] == key[2:]:
+            return row[3]
+        return None
+
+    def put(self, key: CacheKey, algorithm: str, digest: bytes) -> None:
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (key[0], key[1], algorithm, *key[2:], digest))
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.connection.commit()
+                self.pending = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def derive_cached_hash_func(hash_func, cache: HashCache, algorithm: str):
+    def _cached_hash(file_name, file_size, cache_key: Optional[CacheKey]):
+        if cache_key is None:  # no stable inode numbers on this filesystem
+            return hash_func(file_name, file_size)
+        digest = cache.get(cache_key, algorithm)
+        if digest is None:
+            digest = hash_func(file_name, file_size)
+            cache.put(cache_key, algorithm, digest)
+        return digest
+
+    return _cached_hash
@@ -1,12 +1,18 @@
 import argparse
 import os
 import sys
-from typing import AnyStr, Set
+from array import array
+from collections import defaultdict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from typing import AnyStr, FrozenSet, Iterable, List
 
-from fileutils import directory_is_empty, duplicate_found, extension_filter_builder, \
-    path_blacklist_builder, derive_filtered_file_iter, derive_filtered_empty_directory_iter, file_iter, \
-    empty_directory_iter, FileCandidate, sizeof_fmt
-from hash import derive_hash_func, derive_hash_builder, HASH_FUNC
+from fileutils import duplicate_found, extension_filter_builder, \
+    path_blacklist_builder, same_content, walk_once, FileCandidate, sizeof_fmt
+from cache import derive_cached_hash_func, HashCache, CACHE_PATH
+from hash import hash_file, hash_name, partial_hash, CRYPTOGRAPHIC_HASH_FUNC, HASH_FUNC, PARTIAL_HASH_FUNC, \
+    PARTIAL_SIZE
 
 EPILOG = f'''Example usage:
 // The program can use hash function of your choice, see hashlib for details
@@ -18,55 +24,166 @@ $ python3 {sys.argv[0]} -d /tmp/test -f jpg,png -e -o -n
 $ python3 {sys.argv[0]} -d /tmp/test -f jpg,png -e -o
 '''
 
+# hashlib releases the GIL while hashing, so threads scale with both cores and disk queue depth
+HASH_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+# Files smaller than this are hashed or compared on the main thread
+INLINE_HASH_SIZE = 64 * 1024
+
 
 def delete_empty_directories(empty_directories: [AnyStr], remove: bool = False) -> None:
     counter = 0
-    freed_size = 0
+    # Emptiness is known from the walk, children come before their parents so a parent is empty by its turn
     for full_dir_path in empty_directories:
-        if directory_is_empty(full_dir_path):
-            counter += 1
-            freed_size += os.path.getsize(full_dir_path)
-            if remove:
-                print(f"Removing empty directory: {full_dir_path}")
-                os.removedirs(full_dir_path)
-            else:
-                print(f"Empty directory: {full_dir_path}")
+        counter += 1
+        if remove:
+            print(f"Removing empty directory: {full_dir_path}")
+            os.rmdir(full_dir_path)
+        else:
+            print(f"Empty directory: {full_dir_path}")
     if remove:
-        print(f"Total empty directories removed: {counter}, freed size: {sizeof_fmt(freed_size)}")
+        print(f"Total empty directories removed: {counter}")
+    else:
+        print(f"Total empty directories found: {counter}")
+    sys.stdout.flush()
+
+
+def select_duplicate(prev_file: FileCandidate, test_file: FileCandidate,
+                     keep_oldest: bool = True) -> (FileCandidate, FileCandidate):
+    """
+    :param prev_file: a file already kept
+    :param test_file: a file with the same content
+    :return: tuple of the file to keep and the duplicate
+    """
+    if keep_oldest:
+        keep_test_file = test_file.last_modified < prev_file.last_modified
     else:
-        print(f"Total empty directories found: {counter}, total size: {sizeof_fmt(freed_size)}")
+        keep_test_file = test_file.last_modified > prev_file.last_modified
+    return (test_file, prev_file) if keep_test_file else (prev_file, test_file)
+
+
+def submit_hashes(executor: Executor, hash_func, candidates: [FileCandidate],
+                  with_keys: bool = False) -> Iterable[bytes]:
+    """
+    :param with_keys: pass the cache keys of the candidates to hash_func as well
+    :return: digests of the candidates in the same order
+    """
+    args = [[c.path for c in candidates], [c.size for c in candidates]]
+    if with_keys:
+        args.append([c.cache_key for c in candidates])
+    if candidates[0].size < INLINE_HASH_SIZE:  # submission overhead outweighs hashing
+        return map(hash_func, *args)
+    return executor.map(hash_func, *args)
+
+
+def group_by_digest(candidates: [FileCandidate], digests: Iterable[bytes]) -> Iterable[List[FileCandidate]]:
+    groups = defaultdict(list)
+    for test_file, digest in zip(candidates, digests):
+        groups[digest].append(test_file)
+    return groups.values()
 
 
-def remove_duplicates(files, keep_oldest=True, remove=False):
-    hash_func = derive_hash_func(derive_hash_builder(False), HASH_FUNC)
-    hash_dict = {}
+def remove_duplicates(files, keep_oldest=True, remove=False, cryptographic=False, verify=False,
+                      cache: HashCache = None):
+    algorithm = CRYPTOGRAPHIC_HASH_FUNC if cryptographic else HASH_FUNC
+    hash_func = partial(hash_file, hash_func=algorithm)
+    partial_func = partial_hash
+    with_keys = cache is not None
+    if cache is not None:  # skip reading files unchanged since a previous run
+        hash_func = derive_cached_hash_func(hash_func, cache, hash_name(algorithm))
+        # SQLite integers are signed 64 bit, so partial digests are cached as bytes
+        partial_func = derive_cached_hash_func(partial(partial_hash, as_bytes=True), cache,
+                                               f'{hash_name(PARTIAL_HASH_FUNC)} head and tail {PARTIAL_SIZE}')
+    # Files with a unique size cannot have duplicates, group them by size before reading any content
+    # Struct of arrays: files are streamed from the walk, so each stat result is dropped once its modification
+    # time is kept in 8 bytes, and paths are stored as an index into a shared directory table plus an interned name
+    dir_table = {}
+    dir_ids = array('L')
+    names = []
+    last_modified = array('d')
+    size_map = defaultdict(list)  # size -> indexes into dir_ids, names and last_modified
+    # Cache keys come from the stat result of the walk, so no file is stat'ed again
+    devices = array('Q')
+    inodes = array('Q')
+    mtimes_ns = array('q')
+    ctimes_ns = array('q')
+    for file_name, file_stat in files:
+        directory, name = os.path.split(file_name)
+        size_map[file_stat.st_size].append(len(names))
+        dir_ids.append(dir_table.setdefault(directory, len(dir_table)))
+        names.append(sys.intern(name))
+        last_modified.append(max(file_stat.st_ctime, file_stat.st_mtime))
+        if cache is not None:
+            devices.append(file_stat.st_dev)
+            inodes.append(file_stat.st_ino)
+            mtimes_ns.append(file_stat.st_mtime_ns)
+            ctimes_ns.append(file_stat.st_ctime_ns)
+    directories = list(dir_table)  # dict keeps insertion order, so list index is the directory id
+    del dir_table
+
+    def new_candidate(i: int, size: int) -> FileCandidate:
+        cache_key = None
+        if cache is not None and inodes[i]:  # without stable inode numbers the file can't be looked up
+            cache_key = (devices[i], inodes[i], size, mtimes_ns[i], ctimes_ns[i])
+        return FileCandidate(os.path.join(directories[dir_ids[i]], names[i]), size, last_modified[i], cache_key)
+
     counter = 0
     freed_size = 0
-    for file_name in files:
-        digest = hash_func(file_name)
-        test_file = FileCandidate(file_name)
-        if digest in hash_dict:
-            prev_file = hash_dict[digest]
-            last_modified = test_file.last_modified
-            counter += 1
-            if keep_oldest:
-                if prev_file.last_modified <= last_modified:
-                    freed_size += duplicate_found(test_file, remove)
-                else:
-                    freed_size += duplicate_found(prev_file, remove)
-                    hash_dict[digest] = FileCandidate(file_name)
-            else:
-                if prev_file.last_modified >= last_modified:
-                    freed_size += duplicate_found(test_file, remove)
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        try:
+            # Submit every hash up front so workers keep busy while results are consumed in order
+            hashed_buckets = []
+            partial_buckets = []
+            pairs = []
+            inline_pairs = []
+            for size, same_size in size_map.items():
+                if len(same_size) < 2:
+                    continue
+                # FileCandidate is only built for files which may have duplicates
+                candidates = [new_candidate(i, size) for i in same_size]
+                # A byte comparison leaves nothing to cache, with the cache pairs take the partial and full hashes
+                if len(candidates) == 2 and cache is None:
+                    (pairs if size >= INLINE_HASH_SIZE else inline_pairs).append(candidates)
+                elif size > PARTIAL_SIZE:  # compare head and tail before reading whole files
+                    partial_buckets.append((candidates, submit_hashes(executor, partial_func, candidates, with_keys)))
                 else:
-                    freed_size += duplicate_found(prev_file, remove)
-                    hash_dict[digest] = FileCandidate(file_name)
-        else:
-            hash_dict[digest] = test_file
+                    hashed_buckets.append((candidates, submit_hashes(executor, hash_func, candidates, with_keys)))
+            # Byte comparison stops on the first differing block
+            pairs_equal = executor.map(same_content, [p.path for p, _ in pairs], [t.path for _, t in pairs])
+            # Like small hashes, small pairs are compared on the main thread while the workers are busy
+            inline_pairs_equal = map(same_content, [p.path for p, _ in inline_pairs], [t.path for _, t in inline_pairs])
+
+            for candidates, partial_digests in partial_buckets:
+                for group in group_by_digest(candidates, partial_digests):
+                    if len(group) >= 2:
+                        hashed_buckets.append((group, submit_hashes(executor, hash_func, group, with_keys)))
+
+            for (prev_file, test_file), equal in chain(zip(inline_pairs, inline_pairs_equal), zip(pairs, pairs_equal)):
+                if equal:
+                    counter += 1
+                    _, duplicate = select_duplicate(prev_file, test_file, keep_oldest)
+                    freed_size += duplicate_found(duplicate, remove)
+
+            for candidates, digests in hashed_buckets:
+                # Files of different size are never duplicates, a small table per bucket never grows large
+                hash_dict = {}
+                for test_file, digest in zip(candidates, digests):
+                    prev_file = hash_dict.setdefault(digest, test_file)  # single lookup for unique files
+                    if prev_file is test_file:
+                        continue
+                    if verify and not same_content(prev_file.path, test_file.path):
+                        continue  # hash collision
+                    counter += 1
+                    hash_dict[digest], duplicate = select_duplicate(prev_file, test_file, keep_oldest)
+                    freed_size += duplicate_found(duplicate, remove)
+        except BaseException:  # a failing file or Ctrl-C
+            # Don't let shutdown(wait=True) on exit hash everything still queued before the error surfaces
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
     if remove:
         print(f"Total duplicates removed: {counter}, freed size: {sizeof_fmt(freed_size)}")
     else:
         print(f"Total duplicates found: {counter}, total duplicates size: {sizeof_fmt(freed_size)}")
+    sys.stdout.flush()
 
 
 def get_parent_directory(parent_dir: AnyStr) -> AnyStr:
@@ -88,14 +205,14 @@ def process_comma_separated_values(raw_str: AnyStr) -> [AnyStr]:
     return result
 
 
-def build_extensions(raw_extensions: AnyStr) -> Set[AnyStr]:
+def build_extensions(raw_extensions: AnyStr) -> FrozenSet[AnyStr]:
     extensions_set = set()
     if raw_extensions:
         if ',' in raw_extensions:
-            extensions_set.update(('.' + e.strip()) for e in raw_extensions.split(','))
+            extensions_set.update(('.' + e.strip().lower()) for e in raw_extensions.split(','))
         else:
-            extensions_set.add('.' + raw_extensions)
-    return extensions_set
+            extensions_set.add('.' + raw_extensions.strip().lower())
+    return frozenset(extensions_set)
 
 
 if __name__ == "__main__":
@@ -114,9 +231,20 @@ if __name__ == "__main__":
                         default=False, action='store_false')
     parser.add_argument("--empty", "-e", help="Remove empty directories", required=False,
                         default=False, action='store_true')
+    parser.add_argument("--cryptographic", "-c",
+                        help=f"Compare files with cryptographic {hash_name(CRYPTOGRAPHIC_HASH_FUNC)} "
+                             f"(default: {hash_name(HASH_FUNC)})", required=False, default=False, action='store_true')
+    parser.add_argument("--verify", "-v", help="Compare files with equal hashes byte by byte", required=False,
+                        default=False, action='store_true')
+    parser.add_argument("--cache", help=f"Reuse hashes of unchanged files between runs, stored in {CACHE_PATH}",
+                        required=False, default=False, action='store_true')
 
     args = parser.parse_args()
 
+    # One line is printed per duplicate, don't flush a terminal on every line
+    if hasattr(sys.stdout, 'reconfigure'):
+        sys.stdout.reconfigure(line_buffering=False)
+
     # Get starting directory for duplicate analysis
     root_dir = get_parent_directory(args.directory)
     print(f'Searching for duplicates in: {root_dir}')
@@ -132,15 +260,16 @@ if __name__ == "__main__":
         blacklist = process_comma_separated_values(args.path_blacklist)
         path_blacklists.append(path_blacklist_builder(blacklist))
 
-    custom_file_iter = file_iter
-    custom_dir_iter = empty_directory_iter
-    # If specified, build file iterator given extension filters and blacklists
-    if filename_filters or path_blacklists:
-        custom_file_iter = derive_filtered_file_iter(filename_filters, path_blacklists)
-        if path_blacklists:
-            custom_dir_iter = derive_filtered_empty_directory_iter(path_blacklists)
+    # Walk the tree once for both files and empty directories, files are streamed into the size buckets
+    files, empty_dirs = walk_once(root_dir, filename_filters, path_blacklists)
 
-    remove_duplicates(custom_file_iter(root_dir), keep_oldest=args.oldest, remove=args.remove)
+    hash_cache = HashCache() if args.cache else None
+    try:
+        remove_duplicates(files, keep_oldest=args.oldest, remove=args.remove,
+                          cryptographic=args.cryptographic, verify=args.verify, cache=hash_cache)
+    finally:  # commit the digests hashed so far even if the run fails
+        if hash_cache is not None:
+            hash_cache.close()
 
     if args.empty:  # Analyze or remove empty directories
-        delete_empty_directories(custom_dir_iter(root_dir), args.remove)
+        delete_empty_directories(empty_dirs, args.remove)
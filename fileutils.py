@@ -1,14 +1,25 @@
 import os
+import re
+import threading
 from datetime import datetime
-from typing import AnyStr, Callable, Iterable
+from typing import AnyStr, Callable, Iterable, List, Optional, Tuple
+
+from hash import FADVISE
+
+try:  # optional, speeds up long path blacklists
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 class FileCandidate:
-    def __init__(self, path):
+    __slots__ = ('path', 'last_modified', 'size', 'cache_key')  # one instance per file, skip the per-instance __dict__
+
+    def __init__(self, path: AnyStr, size: int, last_modified: float, cache_key: Optional[tuple] = None):
         self.path = path
-        file_stat = os.stat(path)
-        self.last_modified = get_last_modification_time(file_stat)
-        self.size = file_stat.st_size
+        self.last_modified = last_modified
+        self.size = size
+        self.cache_key = cache_key
 
     def __repr__(self):
         return f"{self.path} with the size {self.size} modified at {self.last_modified}"
@@ -26,52 +37,188 @@ def duplicate_found(file: FileCandidate, do_delete=False) -> int:
     return file.size
 
 
+# Two reusable read buffers per comparing thread
+compare_buffers = threading.local()
+
+
+def read_block(file, view: memoryview) -> int:
+    """
+    :param file: a file opened unbuffered
+    :param view: buffer to fill
+    :return: bytes read, fewer than the buffer size only at the end of the file
+    """
+    size = 0
+    while size < len(view):  # a raw read may return less than asked for
+        read = file.readinto(view[size:])
+        if not read:
+            break
+        size += read
+    return size
+
+
+def same_content(path1: AnyStr, path2: AnyStr, block_size: int = 128 * 1024) -> bool:
+    """
+    Byte by byte comparison like filecmp.cmp(shallow=False), but without stat'ing both files again
+    :param path1: a file path
+    :param path2: a file path of the same size
+    :param block_size: bytes compared at once
+    :return: True if both files have the same content
+    """
+    buffers = getattr(compare_buffers, 'buffers', None)
+    if buffers is None or len(buffers[0]) != block_size:
+        buffers = compare_buffers.buffers = (bytearray(block_size), bytearray(block_size))
+    buffer1, buffer2 = buffers
+    # Unbuffered files readinto the reusable buffers, no new bytes objects per block
+    with open(path1, 'rb', buffering=0) as f1, open(path2, 'rb', buffering=0) as f2, \
+            memoryview(buffer1) as view1, memoryview(buffer2) as view2:
+        if FADVISE:
+            for f in (f1, f2):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            size = read_block(f1, view1)
+            # memoryview == compares item by item, startswith compares the views with memcmp
+            if read_block(f2, view2) != size or not buffer1.startswith(view2[:size]):
+                equal = False
+                break
+            if size < block_size:
+                equal = True
+                break
+        if FADVISE:
+            for f in (f1, f2):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return equal
+
+
 def directory_is_empty(path: AnyStr) -> bool:
     """
     :param path: a directory path
     :return: True if directory is empty, False otherwise
     """
-    return not any(os.scandir(path))
+    with os.scandir(path) as it:
+        return next(it, None) is None
+
+
+def all_of(filters: []) -> Optional[Callable[[AnyStr], bool]]:
+    """
+    Specialize the filters once instead of running a generator over them for every file
+    :param filters: filter functions
+    :return: None without filters, the filter itself if there is only one, otherwise a function requiring all of them
+    """
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return lambda value: all(f(value) for f in filters)
+
+
+def any_of(filters: []) -> Optional[Callable[[AnyStr], bool]]:
+    """
+    :param filters: filter functions
+    :return: None without filters, the filter itself if there is only one, otherwise a function requiring any of them
+    """
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return lambda value: any(f(value) for f in filters)
+
+
+def scandir_walk(directory_name: AnyStr, path_blacklists: [] = ()) -> Iterable[
+    Tuple[AnyStr, List[os.DirEntry], List[os.DirEntry]]]:
+    """
+    Bottom-up walk like os.walk(topdown=False), but keeps the DirEntry objects so their cached type and stat are reused
+    :param directory_name: a directory path
+    :param path_blacklists: blacklist functions, a blacklisted directory is skipped with all its subdirectories
+    :return: tuples of directory path, subdirectory entries and file entries
+    """
+    in_blacklist = any_of(path_blacklists)
+    # Explicit stack instead of recursion: no recursion limit and no yield from chain per directory level
+    stack = [directory_name]
+    while stack:
+        top = stack.pop()
+        if isinstance(top, tuple):  # all subdirectories were walked
+            yield top
+            continue
+        if in_blacklist is not None and in_blacklist(top):  # skip the path from blacklist
+            continue
+        dirs = []
+        files = []
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        dirs.append(entry)
+                    else:
+                        files.append(entry)
+        except OSError:  # unreadable directory, os.walk ignores it as well
+            continue
+        stack.append((top, dirs, files))
+        stack.extend(entry.path for entry in reversed(dirs) if not entry.is_symlink())
+
+
+def walk_once(directory_name: AnyStr, filename_filters: [] = (), path_blacklists: [] = ()) -> Tuple[
+    Iterable[Tuple[AnyStr, os.stat_result]], List[AnyStr]]:
+    """
+    Collect files and empty directories in a single walk of the tree
+    :param directory_name: a directory path
+    :param filename_filters: filename filters, apply only to the returned files
+    :param path_blacklists: blacklist functions, a blacklisted directory is skipped with all its subdirectories
+    :return: lazy iterator of file paths with their stat result, so no list of every stat result is kept,
+             and the empty directories, children before their parents, filled in while the files are consumed
+    """
+    empty_dirs = []
+    filename_filter = all_of(filename_filters)
+
+    def _files() -> Iterable[Tuple[AnyStr, os.stat_result]]:
+        dir_has_content = {}
+        for root, dirs, dir_files in scandir_walk(directory_name, path_blacklists):
+            for entry in dir_files:
+                if filename_filter is None or filename_filter(entry.name):
+                    yield entry.path, entry.stat()
+            # Subdirectories which were not walked (symlinks, blacklisted) count as content
+            has_content = bool(dir_files)
+            for entry in dirs:
+                has_content = dir_has_content.pop(entry.path, True) or has_content
+            dir_has_content[root] = has_content
+            if not has_content and root != directory_name:
+                empty_dirs.append(root)
+
+    return _files(), empty_dirs
 
 
 def derive_filtered_file_iter(filename_filters: [] = None, path_blacklists: [] = None) -> Callable[
-    [AnyStr], Iterable[AnyStr]]:
-    def _filtered_file_iter(directory_name: AnyStr) -> Iterable[AnyStr]:
-        for root, _, files in os.walk(directory_name, topdown=False):
-            if any(in_blacklist(root) for in_blacklist in path_blacklists):  # skip the path from blacklist
-                continue
-            for filename in files:
-                if all(filename_filter(filename) for filename_filter in filename_filters):
-                    yield os.path.join(root, filename)
+    [AnyStr], Iterable[Tuple[AnyStr, os.stat_result]]]:
+    def _filtered_file_iter(directory_name: AnyStr) -> Iterable[Tuple[AnyStr, os.stat_result]]:
+        return walk_once(directory_name, filename_filters, path_blacklists)[0]
 
     return _filtered_file_iter
 
 
-def file_iter(directory_name: AnyStr) -> [AnyStr]:
-    for root, _, files in os.walk(directory_name, topdown=False):
-        for filename in files:
-            yield os.path.join(root, filename)
+def file_iter(directory_name: AnyStr) -> Iterable[Tuple[AnyStr, os.stat_result]]:
+    """
+    :param directory_name: a directory path
+    :return: file paths with their stat result, so that no file is stat'ed twice
+    """
+    return walk_once(directory_name)[0]
+
+
+def no_file(_: AnyStr) -> bool:
+    return False
 
 
 def derive_filtered_empty_directory_iter(path_blacklists: [] = None) -> Callable[[AnyStr], Iterable[AnyStr]]:
     def _filtered_empty_directory_iter(directory_name: AnyStr) -> [AnyStr]:
-        for root, dirs, _ in os.walk(directory_name, topdown=False):
-            if any(in_blacklist(root) for in_blacklist in path_blacklists):  # skip the path from blacklist
-                continue
-            for subdir in dirs:
-                subdir_path = os.path.join(root, subdir)
-                if directory_is_empty(subdir_path):  # directory is empty
-                    yield subdir_path
+        # Same emptiness as walk_once, no file passes the filter so none is stat'ed
+        files, empty_dirs = walk_once(directory_name, (no_file,), path_blacklists)
+        for _ in files:  # the walk runs while the files are consumed
+            pass
+        return empty_dirs
 
     return _filtered_empty_directory_iter
 
 
 def empty_directory_iter(directory_name: AnyStr) -> [AnyStr]:
-    for root, dirs, _ in os.walk(directory_name, topdown=False):
-        for subdir in dirs:
-            subdir_path = os.path.join(root, subdir)
-            if directory_is_empty(subdir_path):  # directory is empty
-                yield subdir_path
+    return derive_filtered_empty_directory_iter()(directory_name)
 
 
 def extension_filter_builder(extensions: [AnyStr]) -> Callable[[AnyStr], bool]:
@@ -80,15 +227,19 @@ def extension_filter_builder(extensions: [AnyStr]) -> Callable[[AnyStr], bool]:
     :param extensions: whitelist of extensions
     :return: Function that checks if filename is in the whitelist
     """
+    extensions = frozenset(e.lower() for e in extensions)
 
     def _extension_filter(filename: AnyStr) -> bool:
         """
         :param filename: a file name
         :return: True if filename is in the extensions
         """
-        _, extension = os.path.splitext(filename)
-        if extension and extension.lower() in extensions:
-            return True
+        index = filename.rfind('.')
+        if index > 0:  # leading dot is a hidden file, not an extension
+            extension = filename[index:]
+            # Most extensions are already lowercase, lower() allocates a new string
+            if extension in extensions or extension.lower() in extensions:
+                return True
         return False
 
     return _extension_filter
@@ -99,6 +250,26 @@ def path_blacklist_builder(path_blacklist: [AnyStr]) -> Callable[[AnyStr], bool]
     :param path_blacklist: blacklist substrings of path
     :return: Function that checks any path in the blacklist
     """
+    if ahocorasick is not None and path_blacklist:
+        # Single pass automaton over the path, independent of the blacklist size
+        automaton = ahocorasick.Automaton()
+        for black_path in path_blacklist:
+            automaton.add_word(black_path, black_path)
+        automaton.make_automaton()
+
+        def _path_in_automaton(path: AnyStr) -> bool:
+            """
+
+            :param path: a file path without filename
+            :return: True if path was found in the blacklist
+            """
+            return any(automaton.iter(path))
+
+        return _path_in_automaton
+
+    # All substrings in one compiled pattern, searched in C instead of a Python loop per blacklist entry
+    pattern = '|'.join(re.escape(black_path) for black_path in path_blacklist) or '(?!)'  # empty never matches
+    blacklist_search = re.compile(pattern).search
 
     def _path_in_blacklist(path: AnyStr) -> bool:
         """
@@ -106,18 +277,11 @@ def path_blacklist_builder(path_blacklist: [AnyStr]) -> Callable[[AnyStr], bool]
         :param path: a file path without filename
         :return: True if path was found in the blacklist
         """
-        for black_path in path_blacklist:
-            if black_path in path:
-                return True
-        return False
+        return blacklist_search(path) is not None
 
     return _path_in_blacklist
 
 
-def get_last_modification_time(file_stat):
-    return max(file_stat.st_ctime, file_stat.st_mtime)
-
-
 def sizeof_fmt(num, suffix="B"):
     for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
         if abs(num) < 1024.0:
@@ -1,37 +1,127 @@
 import hashlib
+import mmap
+import os
+import threading
 
-BLOCK_SIZE = 4096 * 4096
-# Setup hasher
-# HASH_FUNC = hashlib.md5
-HASH_FUNC = hashlib.sha1
+try:  # optional, much faster non-cryptographic hashes
+    import xxhash
+except ImportError:
+    xxhash = None
 
+try:  # optional, SIMD parallel cryptographic hash
+    import blake3
+except ImportError:
+    blake3 = None
 
-def block_iter(file_to_read, block_size=BLOCK_SIZE):
-    with file_to_read:
-        block = file_to_read.read(block_size)
-        while len(block) > 0:
-            yield block
-            block = file_to_read.read(block_size)
+# Setup hasher, see hashlib.algorithms_available for details
+# CRYPTOGRAPHIC_HASH_FUNC = 'md5'
+# sha256 is accelerated by SHA-NI in OpenSSL on recent CPUs
+CRYPTOGRAPHIC_HASH_FUNC = blake3.blake3 if blake3 is not None else 'sha256'
+# Collision resistance against an adversary is not needed to find duplicates
+HASH_FUNC = xxhash.xxh3_128 if xxhash is not None else 'sha256'
+# Read buffers small enough to stay in L2 while the hasher consumes them
+SMALL_BLOCK_SIZE = 128 * 1024
+BLOCK_SIZE = 256 * 1024
+# Files at least this large are hashed from a memory map
+MMAP_SIZE = 1024 * 1024
+MADVISE = hasattr(mmap, 'MADV_SEQUENTIAL')
+# Files are read once front to back, widen readahead and drop the pages afterwards
+FADVISE = hasattr(os, 'posix_fadvise')
+# 128 bits are plenty to tell files apart, longer digests are truncated
+DIGEST_SIZE = 16
+# Bytes read from the head and from the tail of a file for the partial hash
+PARTIAL_SIZE = 64 * 1024
+# 64 bits are enough to sort out files, equal partial hashes are confirmed by the full hash
+PARTIAL_HASH_FUNC = xxhash.xxh3_64 if xxhash is not None else CRYPTOGRAPHIC_HASH_FUNC
 
 
-def hash_builder(batch_bytes, hasher):
-    for block in batch_bytes:
-        hasher.update(block)
+def block_size(file_size):
+    return SMALL_BLOCK_SIZE if file_size < BLOCK_SIZE else BLOCK_SIZE
+
+
+def new_hasher(hash_func):
+    """
+    :param hash_func: hashlib algorithm name or a hash constructor
+    :return: new hash object
+    """
+    return hashlib.new(hash_func) if isinstance(hash_func, str) else hash_func()
+
+
+def hash_name(hash_func):
+    """
+    :param hash_func: hashlib algorithm name or a hash constructor
+    :return: algorithm name
+    """
+    return new_hasher(hash_func).name.lower()
+
+
+def mmap_digest(file_to_read, hash_func, _bufsize=None):
+    """
+    Hash large files without copying them into Python buffers, fallback for Python < 3.11 without hashlib.file_digest
+    :param file_to_read: a file object opened in binary mode
+    :param hash_func: hashlib algorithm name or a hash constructor
+    :param _bufsize: unused, the whole file is mapped at once
+    :return: hash object updated with the whole file content in one call
+    """
+    hasher = new_hasher(hash_func)
+    if os.fstat(file_to_read.fileno()).st_size:  # empty files can't be mapped
+        with mmap.mmap(file_to_read.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if MADVISE:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            hasher.update(mm)
     return hasher
 
 
-def derive_hash_builder(hex_str=False):
-    def _hex_digest(bytes_batch, hasher):
-        return hash_builder(bytes_batch, hasher).hexdigest()
+file_digest = getattr(hashlib, 'file_digest', mmap_digest)
+
 
-    def _digest(bytes_batch, hasher):
-        return hash_builder(bytes_batch, hasher).digest()
+def hash_file(file_name, file_size=BLOCK_SIZE, hash_func=HASH_FUNC):
+    """
+    :param file_name: a file path
+    :param file_size: file size, selects between memory map and the read buffer size
+    :param hash_func: hashlib algorithm name or a hash constructor
+    :return: raw digest of the whole file truncated to DIGEST_SIZE, bytes keys are cheaper than hex strings
+    """
+    # Unbuffered file lets file_digest readinto its single reusable buffer without an extra copy
+    with open(file_name, 'rb', buffering=0) as f:
+        if FADVISE:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        hasher = None
+        if file_size >= MMAP_SIZE:
+            try:
+                hasher = mmap_digest(f, hash_func)
+            except (OSError, OverflowError, ValueError):  # can't be mapped, f.e. address space exhausted
+                pass
+        if hasher is None:
+            hasher = file_digest(f, hash_func, _bufsize=block_size(file_size))
+        digest = hasher.digest()[:DIGEST_SIZE]
+        if FADVISE:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return digest
 
-    return _hex_digest if hex_str else _digest
 
+# One reusable read buffer per hashing thread
+partial_buffers = threading.local()
 
-def derive_hash_func(hash_factory, hash_func):
-    def _hash(file_name):
-        return hash_factory(block_iter(open(file_name, 'rb')), hash_func())
 
-    return _hash
+def partial_hash(file_name, file_size, partial_size=PARTIAL_SIZE, as_bytes=False):
+    """
+    Cheap first level key, files with different partial hashes can't be duplicates
+    :param file_name: a file longer than partial_size
+    :param file_size: file size, the tail is read only if it doesn't overlap the head
+    :param partial_size: bytes read from each end of the file
+    :param as_bytes: return bytes even when xxhash is available
+    :return: digest of the first and the last partial_size bytes, an int when xxhash is available
+    """
+    hasher = new_hasher(PARTIAL_HASH_FUNC)
+    buffer = getattr(partial_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != partial_size:
+        buffer = partial_buffers.buffer = bytearray(partial_size)
+    with open(file_name, 'rb', buffering=0) as f, memoryview(buffer) as view:
+        hasher.update(view[:f.readinto(buffer)])
+        if file_size > 2 * partial_size:
+            f.seek(-partial_size, os.SEEK_END)
+            hasher.update(view[:f.readinto(buffer)])
+    if xxhash is not None and not as_bytes:  # int key hashes and compares cheaper than bytes
+        return hasher.intdigest()
+    return hasher.digest()